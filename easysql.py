@@ -1,30 +1,141 @@
 # -*- coding: utf-8 -*-
 
+import csv
+import hashlib
+import json
 import os
-from functools import cached_property
+import pickle
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import cached_property, lru_cache
+from typing import TYPE_CHECKING
+from uuid import UUID
 
-import tablib
 from sqlalchemy import MetaData
 from sqlalchemy import Table as SaTable
 from sqlalchemy import create_engine, text
 from sqlalchemy.sql import select
 
+if TYPE_CHECKING:
+    import tablib
+
+
+# Reflected MetaData of each database URL, shared inside Database.caching_schema().
+_META_CACHE = {}
+
+# Number of rows fetched at once from the cursor of a query.
+_FETCH_SIZE = 10000
+
+# Values of these types are exported as they are, without any reduction.
+_PLAIN_TYPES = (bool, int, float, str, bytes, Decimal)
+
+
+def _reduce_datetime(value):
+    """Converts a datetime to a string, leaving any other value untouched."""
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _json_default(obj):
+    """Serializes what json cannot, the same way as tablib's JSON export."""
+    if isinstance(obj, (Decimal, UUID)):
+        return str(obj)
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _reduce_rows(rows, schema):
+    """Yields the reduced values of many rows sharing a schema, visiting only the columns that need it."""
+    columns = None
+    for row in rows:
+        if row._schema is not schema:
+            yield row.values(reduce_datetimes=True)
+            continue
+
+        if columns is None:
+            reducers = schema.get_reducers(row._values)
+            columns = [(i, r) for i, r in enumerate(reducers) if r is not None]
+        if not columns:
+            yield row._values
+            continue
+
+        values = list(row._values)
+        for i, r in columns:
+            values[i] = r(values[i])
+        yield values
+
+
+class RowSchema:
+    """The column names shared by the rows of a query, indexed once for all of them."""
+
+    __slots__ = ('keys', 'index', 'dups', 'reducers', 'needs_reduce', 'forced')
+
+    def __init__(self, keys: list):
+        self.keys = keys
+
+        # Map each key to its first index, remembering the duplicated ones.
+        self.index = {}
+        dups = set()
+        for i, k in enumerate(keys):
+            if self.index.setdefault(k, i) != i:
+                dups.add(k)
+        self.dups = frozenset(dups)
+
+        self.reducers = None
+        self.needs_reduce = True
+        # Columns widened by Row.set() before the reducers were decided.
+        self.forced = set()
+
+    def get_reducers(self, values: list) -> tuple:
+        """Returns the datetime reducer of each column, or None for the columns of plain values.
+        The reducers are decided once, from the first row asking for them, and the forced columns."""
+        if self.reducers is None:
+            forced = self.forced
+            self.reducers = tuple(None if isinstance(v, _PLAIN_TYPES) and i not in forced else _reduce_datetime
+                                  for i, v in enumerate(values))
+            self.needs_reduce = any(r is not None for r in self.reducers)
+        return self.reducers
+
+    def widen_reducer(self, i: int, value):
+        """Makes the column i reducible if the value set into it cannot be exported as it is."""
+        if isinstance(value, _PLAIN_TYPES):
+            return
+        if self.reducers is None:
+            self.forced.add(i)
+            return
+        if self.reducers[i] is not None:
+            return
+
+        self.reducers = self.reducers[:i] + (_reduce_datetime,) + self.reducers[i + 1:]
+        self.needs_reduce = True
+
 
 class Row:
     """A row from a table of a database."""
 
-    def __init__(self, keys: list, values: list, table=None, database=None):
-        self._keys = keys
-        self._values = values
+    __slots__ = ('_schema', '_keys', '_values', '_table', '_database', '_asdict')
+
+    def __init__(self, keys, values: tuple, table=None, database=None):
+        self._values = values if isinstance(values, tuple) else tuple(values)
         self._table = table
         self._database = database
-        assert len(self._keys) == len(self._values)
+
+        # Rows from the same query share one RowSchema instead of a list of keys.
+        # Their width is the one of the cursor, so only standalone rows are checked.
+        if isinstance(keys, RowSchema):
+            self._schema = keys
+        else:
+            self._schema = RowSchema(keys)
+            assert len(keys) == len(self._values)
+        self._keys = self._schema.keys
 
     def __repr__(self) -> str:
         return '<Row {}>'.format(str(self))
 
     def __str__(self) -> str:
-        return self.export('json')[1:-1]
+        # A row is flat, so the encoder can skip the circular reference checks.
+        return json.dumps(dict(zip(self._keys, self.values(reduce_datetimes=True))),
+                          separators=(',', ':'), check_circular=False, default=_json_default, ensure_ascii=False)
 
     def __len__(self) -> int:
         return len(self._keys)
@@ -32,16 +143,16 @@ class Row:
     def __getitem__(self, key):
         # Support for index-based lookup.
         if isinstance(key, int):
-            return self.values()[key]
+            return self._values[key]
 
         # Support for key-based lookup.
-        if key in self.keys():
-            i = self.keys().index(key)
-            if self.keys().count(key) > 1:
-                raise KeyError("Multiple '{}' fields.".format(key))
-            return self.values()[i]
-
-        raise KeyError("No '{}' field.".format(key))
+        schema = self._schema
+        i = schema.index.get(key)
+        if i is None:
+            raise KeyError("No '{}' field.".format(key))
+        if schema.dups and key in schema.dups:
+            raise KeyError("Multiple '{}' fields.".format(key))
+        return self._values[i]
 
     # TODO: fix the conflict between __getattr__ and @property
     # def __getattr__(self, key):
@@ -55,11 +166,12 @@ class Row:
             yield z
 
     @property
-    def dataset(self) -> tablib.Dataset:
+    def dataset(self) -> 'tablib.Dataset':
         """A Tablib Dataset representation of the Row."""
-        data = tablib.Dataset(headers=self.keys())
-        data.append(self.values(reduce_datetimes=True))
-        return data
+        # Tablib and its format backends are only imported once a Dataset is needed.
+        import tablib
+
+        return tablib.Dataset(self.values(reduce_datetimes=True), headers=self.keys())
 
     @property
     def table(self):
@@ -76,8 +188,22 @@ class Row:
         return self._keys
 
     def values(self, reduce_datetimes=False):
-        """Returns the list of values from the query."""
-        return self._reduce_datetimes(self._values) if reduce_datetimes else self._values
+        """Returns the tuple of values from the query."""
+        if not reduce_datetimes:
+            return self._values
+
+        reducers = self._schema.get_reducers(self._values)
+        if not self._schema.needs_reduce:
+            return self._values
+        return tuple(v if r is None else r(v) for v, r in zip(self._values, reducers))
+
+    def as_dict(self) -> dict:
+        """Returns the row as a dict, built on the first call and reused afterwards.
+        The dict is shared between calls, so copy it before modifying it."""
+        d = getattr(self, '_asdict', None)
+        if d is None:
+            d = self._asdict = dict(zip(self._keys, self._values))
+        return d
 
     def get(self, key, default=None):
         """Returns the value for a given key, or default."""
@@ -88,8 +214,12 @@ class Row:
 
     def set(self, key, value):
         """Sets the value of the key, without saving to database."""
-        i = self._keys.index(key)
-        self._values[i] = value
+        i = self._schema.index.get(key)
+        if i is None:
+            raise ValueError("No '{}' field.".format(key))
+        self._values = self._values[:i] + (value,) + self._values[i + 1:]
+        self._asdict = None
+        self._schema.widen_reducer(i, value)
 
     def save(self) -> bool:
         """Saves changes to database based on the primary key."""
@@ -101,21 +231,33 @@ class Row:
 
     def export(self, format, **kwargs):
         """Exports the row to the given format."""
+        if format == 'json':
+            if kwargs:
+                raise TypeError('The json format takes no options: {}.'.format(', '.join(sorted(kwargs))))
+            return '[{}]'.format(self)
         return self.dataset.export(format, **kwargs)
 
     @staticmethod
-    def _reduce_datetimes(input: list) -> list:
-        """Receives a list and converts datetimes to strings in it."""
-        return [r.isoformat() if hasattr(r, 'isoformat') else r for r in input]
+    def _reduce_datetimes(input: list) -> tuple:
+        """Receives a list and returns it as a tuple, with datetimes converted to strings."""
+        return tuple(map(_reduce_datetime, input))
 
 
 class RowSet:
     """A set of rows from a table of a database."""
 
+    __slots__ = ('_pre_rows', '_all_rows', 'pending')
+
     def __init__(self, rows):
-        self._pre_rows = rows
-        self._all_rows = []
-        self.pending = True
+        if isinstance(rows, list):
+            # Already materialized rows need no generator at all.
+            self._pre_rows = iter(())
+            self._all_rows = rows
+            self.pending = False
+        else:
+            self._pre_rows = rows
+            self._all_rows = []
+            self.pending = True
 
     def __repr__(self):
         return '<RowSet fetched={} pending={}>'.format(len(self), self.pending)
@@ -125,11 +267,18 @@ class RowSet:
 
     def __iter__(self):
         """Iterate over all rows, consuming the underlying generator only when necessary."""
+        if not self.pending:
+            # Every row is cached, so iterate over the list directly.
+            return iter(self._all_rows)
+        return self._iter_pending()
+
+    def _iter_pending(self):
+        rows = self._all_rows
         i = 0
         while True:
-            if i < len(self):
+            if i < len(rows):
                 # Check the cached _all_rows first.
-                yield self[i]
+                yield rows[i]
             else:
                 # Enter the generator _pre_rows and throw StopIteration when done.
                 try:
@@ -153,36 +302,40 @@ class RowSet:
         # Convert int into slice.
         sli = slice(key, key + 1) if is_int else key
 
-        while sli.stop is None or len(self) < sli.stop:
+        if sli.stop is None:
+            self._fetch_all()
+
+        while self.pending and len(self) < sli.stop:
             # Turn enough generator _pre_rows into cached _all_rows.
             try:
                 next(self)
             except StopIteration:
                 break
 
-        return self._all_rows[key] if is_int else RowSet(iter(self._all_rows[key]))
+        return self._all_rows[key] if is_int else RowSet(self._all_rows[key])
 
     @property
-    def dataset(self) -> tablib.Dataset:
+    def dataset(self) -> 'tablib.Dataset':
         """A Tablib Dataset representation of the RowSet."""
-        # Create a new Tablib Dataset.
-        data = tablib.Dataset()
+        import tablib
 
         try:
-            # Set the column names as headers on Tablib Dataset.
-            data.headers = self[0].keys()
+            first = self[0]
         except IndexError:
             # If the RowSet is empty, just return the empty set.
-            return data
+            return tablib.Dataset()
 
-        # Set rows.
-        for row in self:
-            data.append(row.values(reduce_datetimes=True))
+        # Create the Tablib Dataset with all the rows at once.
+        return tablib.Dataset(*_reduce_rows(self, first._schema), headers=first.keys())
 
-        return data
+    def _fetch_all(self):
+        """Turns all the remaining generator _pre_rows into cached _all_rows at once."""
+        if self.pending:
+            self._all_rows.extend(self._pre_rows)
+            self.pending = False
 
     def all(self):
-        list(self)
+        self._fetch_all()
         return self
 
     def first(self) -> Row:
@@ -192,7 +345,7 @@ class RowSet:
 
     def one(self) -> Row:
         """Returns the first Row of the RowSet, ensuring that it is the only row."""
-        if len(list(self)) > 1:
+        if len(self.all()) > 1:
             raise ValueError('Contains more than one row.')
 
         return self.first()
@@ -201,15 +354,66 @@ class RowSet:
         """Returns the first column of the first row, or `default`."""
         return self.first()[0]
 
-    def export(self, format, **kwargs):
-        """Exports all the rows in the RowSet to the given format."""
-        return self.dataset.export(format, **kwargs)
+    def export(self, format, stream=None, **kwargs):
+        """Exports all the rows in the RowSet to the given format.
+        If a stream is given, the export is written into it and the stream is returned;
+        csv, json and jsonl are then written row by row without building a Tablib Dataset."""
+        if stream is None:
+            return self.dataset.export(format, **kwargs)
+
+        if format == 'csv':
+            self._write_csv(stream, **kwargs)
+        elif format == 'json':
+            self._write_json(stream)
+        elif format == 'jsonl':
+            self._write_jsonl(stream)
+        else:
+            stream.write(self.dataset.export(format, **kwargs))
+
+        return stream
+
+    def _write_csv(self, stream, **kwargs):
+        try:
+            first = self[0]
+        except IndexError:
+            return
+
+        kwargs.setdefault('delimiter', ',')
+        writer = csv.writer(stream, **kwargs)
+        writer.writerow(first.keys())
+        writer.writerows(_reduce_rows(self, first._schema))
+
+    def _write_json(self, stream):
+        stream.write('[')
+        for i, values in enumerate(self._iter_dicts()):
+            if i:
+                stream.write(', ')
+            stream.write(json.dumps(values, default=_json_default, ensure_ascii=False))
+        stream.write(']')
+
+    def _write_jsonl(self, stream):
+        for values in self._iter_dicts():
+            stream.write(json.dumps(values, default=_json_default, ensure_ascii=False))
+            stream.write('\n')
+
+    def _iter_dicts(self):
+        """Yields each row as a dict of its reduced values."""
+        try:
+            first = self[0]
+        except IndexError:
+            return
+
+        keys = first.keys()
+        for values in _reduce_rows(self, first._schema):
+            yield dict(zip(keys, values))
 
 
 class Executor:
+    __slots__ = ('_table', '_name', '_pre')
+
     def __init__(self, table, clause):
         self._table = table
-        self._name = str(clause).split()[0]
+        self._name = type(clause).__visit_name__.upper()
         self._pre = clause
 
     def where(self, clause):
@@ -221,6 +425,8 @@ class Executor:
 
 
 class Table:
+    __slots__ = ('_table', '_database')
+
     def __init__(self, table: SaTable, database):
         self._table = table
         self._database = database
@@ -290,25 +496,92 @@ class Table:
 
 
 class Database:
-    def __init__(self, db_url=None, **kwargs):
+    _caching_schema = False
+
+    def __init__(self, db_url=None, reflect_cache_path=None, **kwargs):
         self.db_url = db_url or os.environ.get('DATABASE_URL')
         if not self.db_url:
             raise ValueError('A db_url must be provided.')
 
         self._engine = create_engine(self.db_url, pool_pre_ping=True, **kwargs)
         self._conn = self._engine.connect()
-        self._meta = MetaData()
-        self._meta.reflect(bind=self._engine)
+        self._reflect_cache_path = reflect_cache_path
+        self._meta = self._reflect()
         self.open = True
 
     def __repr__(self):
         return '<Database open={}>'.format(self.open)
 
+    @classmethod
+    @contextmanager
+    def caching_schema(cls):
+        """Reflects the schema at most once per URL for the Databases opened inside the context."""
+        previous = cls._caching_schema
+        cls._caching_schema = True
+        try:
+            yield
+        finally:
+            cls._caching_schema = previous
+
+    @staticmethod
+    def clear_reflection_cache():
+        """Forgets the schemas reflected inside caching_schema()."""
+        _META_CACHE.clear()
+
+    def _reflect(self) -> MetaData:
+        """Returns the reflected MetaData of the database, from the caches when possible."""
+        # Every connection to an in-memory SQLite database opens a different one.
+        shared = self._caching_schema and self._engine.url.database not in (None, '', ':memory:')
+        if shared and self.db_url in _META_CACHE:
+            return _META_CACHE[self.db_url]
+
+        meta = self._load_reflection() if self._reflect_cache_path else None
+        if meta is None:
+            meta = MetaData()
+            meta.reflect(bind=self._engine)
+            if self._reflect_cache_path:
+                self._dump_reflection(meta)
+
+        if shared:
+            _META_CACHE[self.db_url] = meta
+        return meta
+
+    def _schema_version(self) -> str:
+        """Returns a digest of the table names, telling whether a pickled schema is outdated.
+        Only the table names are covered: a pickled schema is still used after columns change."""
+        return hashlib.sha1('\n'.join(sorted(self.table_names)).encode()).hexdigest()
+
+    def _load_reflection(self):
+        """Loads the MetaData pickled at reflect_cache_path, or None if missing, unreadable or outdated."""
+        try:
+            with open(self._reflect_cache_path, 'rb') as f:
+                version, meta = pickle.load(f)
+        except Exception:
+            # A broken or incompatible cache file only means reflecting again.
+            return None
+
+        if not isinstance(meta, MetaData) or version != self._schema_version():
+            return None
+        return meta
+
+    def _dump_reflection(self, meta: MetaData):
+        """Pickles the MetaData to reflect_cache_path for the next Database, if the path is writable."""
+        try:
+            with open(self._reflect_cache_path, 'wb') as f:
+                pickle.dump((self._schema_version(), meta), f)
+        except OSError:
+            pass
+
     @cached_property
     def table_names(self) -> list:
         """Returns a list of table names for the connected database."""
         return self._engine.table_names()
 
+    @cached_property
+    def _table_names_set(self) -> frozenset:
+        """The table names as a set, for membership tests."""
+        return frozenset(self.table_names)
+
     def close(self):
         """Closes the Database."""
         self.open = False
@@ -321,17 +594,59 @@ class Database:
 
     def query(self, query, **params):
         """Executes the given SQL query against the connected Database.
+        The query is either a SQL string or an already built statement, such as a text() clause.
         Parameters can, optionally, be provided. Returns a RowSet."""
-        cursor = self._conn.execute(text(query), **params)
+        statement = self._compile(query) if isinstance(query, str) else query
+        cursor = self._conn.execute(statement, **params)
+
+        return RowSet(self._iter_rows(cursor, RowSchema(cursor.keys())))
 
-        return RowSet(Row(cursor.keys(), r, None, self) for r in cursor)
+    def stream_query(self, query, **params):
+        """Executes the given SQL query like query(), but reads the rows through a server-side
+        cursor where the driver supports it, on a dedicated connection closed once all the rows
+        are fetched. Returns a RowSet."""
+        statement = self._compile(query) if isinstance(query, str) else query
+
+        # A dedicated connection keeps the open server-side cursor away from other queries.
+        conn = self._engine.connect()
+        try:
+            cursor = conn.execution_options(stream_results=True, max_row_buffer=_FETCH_SIZE).execute(
+                statement, **params)
+        except BaseException:
+            conn.close()
+            raise
+
+        return RowSet(self._iter_rows(cursor, RowSchema(cursor.keys()), conn))
+
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _compile(query: str):
+        """Returns the TextClause of the query, parsed once per query string."""
+        return text(query)
+
+    def _iter_rows(self, cursor, schema: RowSchema, conn=None):
+        """Yields the Rows of the cursor, fetching them in batches.
+        The connection, if given, is closed once the rows are exhausted or dropped."""
+        # The keys were read from the cursor once, into the schema; hoist the rest too.
+        fetchmany = cursor.fetchmany
+        size = _FETCH_SIZE
+        try:
+            while True:
+                batch = fetchmany(size)
+                if not batch:
+                    return
+                for r in batch:
+                    yield Row(schema, r, None, self)
+        finally:
+            if conn is not None:
+                conn.close()
 
     def bulk_query(self):
         pass
 
     def get_table(self, name) -> Table:
         """Returns a connection to a table of the database."""
-        if name not in self.table_names:
+        if name not in self._table_names_set:
             raise KeyError("Unknown table name '{}'".format(name))
 
         return Table(self._meta.tables[name], self)
@@ -0,0 +1,11 @@
+from pytest import fixture, importorskip
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: integration tests going through the real dependencies.')
+
+
+@fixture(scope="session")
+def tablib_dataset_cls():
+    # Imported on first use only, so collecting the tests never loads tablib.
+    return importorskip("tablib").Dataset
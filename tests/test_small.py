@@ -1,40 +1,127 @@
+import io
 import json
-from collections import OrderedDict
+import pickle
 from datetime import datetime
+from decimal import Decimal
 
-import tablib
-from easysql import Database, Row, RowSet, Table
-from pytest import fixture, raises
+import easysql
+from easysql import Database, Row, RowSchema, RowSet, Table
+from pytest import fixture, mark, raises
+from sqlalchemy import MetaData, text
 
+_RANGE10 = tuple(range(10))
+_STR_RANGE10 = tuple([s] for s in map(str, range(10)))
 
-@fixture
+EPOCH = datetime.fromtimestamp(0)
+EPOCH_ISO = EPOCH.isoformat()
+
+DISPLAY_SIGNAL_Q = text("SELECT * FROM display_signal")
+
+STANDARD_KEYS = ('id', 'name', 'email', 'birthday')
+STANDARD_VALUES = (250, 'Fool', 'fake@unreal.abcd', EPOCH)
+STANDARD_FIELDS = [(i, k, v) for i, (k, v) in enumerate(zip(STANDARD_KEYS, STANDARD_VALUES))]
+
+
+def create_standard_row():
+    return Row(list(STANDARD_KEYS), list(STANDARD_VALUES), "DummyTable", "DummyDatabase")
+
+
+@fixture(scope="session")
 def standard_row():
-    keys = ['id', 'name', 'email', 'birthday']
-    values = [250, 'Fool', 'fake@unreal.abcd', datetime.fromtimestamp(0)]
-    return Row(keys, values, "DummyTable", "DummyDatabase")
+    # Shared by all the tests, so it must only be read.
+    return create_standard_row()
 
 
 @fixture
+def mutable_row():
+    return create_standard_row()
+
+
+@fixture(scope="session")
+def in_memory_url():
+    return "sqlite://"
+
+
+@fixture
+def closable_db(in_memory_url):
+    return Database(in_memory_url)
+
+
+@fixture(scope="module")
 def standard_database():
     return Database(db_url="sqlite:///tests/db.sqlite3")
 
 
+@fixture(scope="module")
+def display_signal_rows(standard_database):
+    return list(standard_database.query(DISPLAY_SIGNAL_Q))
+
+
 @fixture
-def standard_rowset():
-    db = Database(db_url="sqlite:///tests/db.sqlite3")
-    return db.query(("SELECT * FROM display_signal"))
+def standard_rowset(display_signal_rows):
+    # A fresh RowSet for every test, since iterating it changes its state.
+    return RowSet(iter(display_signal_rows))
+
+
+class TestRowSchema:
+    def test___init__(self):
+        keys = ['a', 'b', 'b', 'c']
+
+        schema = RowSchema(keys)
+
+        assert schema.keys is keys
+        assert schema.index == {'a': 0, 'b': 1, 'c': 3}
+        assert schema.dups == frozenset({'b'})
+
+    def test___init___no_dups(self):
+        assert RowSchema(['a', 'b']).dups == frozenset()
+
+    def test_get_reducers(self):
+        schema = RowSchema(['a', 'b', 'c'])
+
+        reducers = schema.get_reducers([1, EPOCH, None])
+
+        assert reducers[0] is None
+        assert reducers[1](EPOCH) == EPOCH_ISO
+        assert reducers[2](None) is None
+        assert schema.needs_reduce is True
+        assert schema.get_reducers(['x', 'y', 'z']) is reducers
+
+    def test_get_reducers_plain(self):
+        schema = RowSchema(['a', 'b'])
+
+        assert schema.get_reducers([1, 'B']) == (None, None)
+        assert schema.needs_reduce is False
 
 
 class TestRow:
-    def test___init___equal_length(self):
+    @mark.parametrize('table, database', [(None, None), ("DummyTable", "DummyDatabase")])
+    def test___init___equal_length(self, table, database):
         keys = ['a', 'b', 'c']
         values = ['A', 'B', 'C']
 
-        row = Row(keys, values)
+        row = Row(keys, values, table, database)
 
         assert row._keys is keys
+        assert row._values == tuple(values)
+        assert row._table == table
+        assert row._database == database
+
+    def test___init___tuple_values(self):
+        values = ('A', 'B', 'C')
+
+        row = Row(['a', 'b', 'c'], values)
+
         assert row._values is values
 
+    def test___init___with_schema(self):
+        schema = RowSchema(['a', 'b'])
+
+        row = Row(schema, ['A', 'B'])
+
+        assert row._schema is schema
+        assert row._keys is schema.keys
+
     def test___init___unequal_length(self):
         keys = ['a', 'b', 'c']
         values = ['A', 'B']
@@ -42,9 +129,8 @@ class TestRow:
         with raises(AssertionError):
             Row(keys, values)
 
-    def test___init___with_table_and_database(self, standard_row):
-        assert standard_row._table == "DummyTable"
-        assert standard_row._database == "DummyDatabase"
+    def test_slots(self):
+        assert not hasattr(Row(['a'], ['A']), '__dict__')
 
     def test___repr__(self, standard_row):
         expectation = '<Row {}>'.format(str(standard_row))
@@ -55,24 +141,40 @@ class TestRow:
 
     def test___str__(self):
         keys = ['a', 'b', 'c', 'd']
-        values = [250, 'B', 'C', datetime.fromtimestamp(0).isoformat()]
-        expectation = json.dumps(OrderedDict(zip(keys, values)))
+        values = [250, 'B', 'C', EPOCH_ISO]
+        expectation = json.dumps(dict(zip(keys, values)), separators=(",", ":"), check_circular=False)
         row = Row(keys, values)
 
         outcome = str(row)
 
         assert outcome == expectation
 
+    def test___str___same_as_export(self, mutable_row):
+        mutable_row.set('name', 'Fööl')
+
+        assert str(mutable_row) == mutable_row.export('json')[1:-1]
+
+    def test___str___json_default(self):
+        row = Row(['a', 'b'], [Decimal('1.50'), 'x'])
+        row.set('b', EPOCH)
+
+        assert str(row) == '{"a":"1.50","b":"%s"}' % EPOCH_ISO
+        assert easysql._json_default(EPOCH) == EPOCH_ISO
+        with raises(TypeError):
+            easysql._json_default(object())
+
     def test___len__(self, standard_row):
         assert len(standard_row) == len(standard_row._keys)
 
     def test___getitem___index_based(self, standard_row):
-        for i in range(len(standard_row)):
-            assert standard_row[i] == standard_row.values()[i]
+        values = standard_row.values()
+        for i, value in enumerate(values):
+            assert standard_row[i] == value
 
-    def test___getitem___key_based(self, standard_row):
-        for key, value in zip(standard_row._keys, standard_row._values):
-            assert standard_row[key] == value
+    @mark.parametrize('idx, key, value', STANDARD_FIELDS)
+    def test___getitem___key_based(self, standard_row, idx, key, value):
+        assert standard_row[key] == value
+        assert standard_row[key] == standard_row[idx]
 
     def test___getitem___multiple_fields(self):
         row = Row(['a', 'b', 'b'], [1, 2, 3])
@@ -92,7 +194,13 @@ class TestRow:
             assert standard_row[k] == v
 
     def test_dataset(self, standard_row):
-        assert isinstance(standard_row.dataset, tablib.Dataset)
+        ds = standard_row.dataset
+
+        assert type(ds).__module__.startswith("tablib")
+
+    @mark.slow
+    def test_dataset_tablib(self, standard_row, tablib_dataset_cls):
+        assert isinstance(standard_row.dataset, tablib_dataset_cls)
 
     def test_table(self, standard_row):
         assert standard_row.table is standard_row._table
@@ -112,24 +220,80 @@ class TestRow:
 
         assert unconverted[-1].isoformat() == converted[-1]
 
-    def test_get(self, standard_row):
-        for i in range(len(standard_row)):
-            assert standard_row.get(i) == standard_row.values()[i]
+    def test_as_dict(self, standard_row):
+        outcome = standard_row.as_dict()
+
+        assert outcome == dict(zip(standard_row._keys, standard_row._values))
+        assert standard_row.as_dict() is outcome
+
+    def test_as_dict_after_set(self, mutable_row):
+        mutable_row.as_dict()
+        mutable_row.set('name', 'newvalue')
 
-        for key, value in zip(standard_row._keys, standard_row._values):
-            assert standard_row.get(key) == value
+        assert mutable_row.as_dict()['name'] == 'newvalue'
+
+    @mark.parametrize('idx, key, value', STANDARD_FIELDS)
+    def test_get(self, standard_row, idx, key, value):
+        assert standard_row.get(idx) == value
+        assert standard_row.get(key) == value
 
     def test_get_failed(self, standard_row):
         assert standard_row.get("absence", "default") == "default"
         assert standard_row.get("absence") is None
 
-    def test_set(self, standard_row):
-        for k in standard_row.keys():
-            standard_row.set(k, k + "newvalue")
-            assert standard_row[k] == k + "newvalue"
+    @mark.parametrize('idx, key, value', STANDARD_FIELDS)
+    def test_set(self, mutable_row, idx, key, value):
+        mutable_row.set(key, key + "newvalue")
+
+        assert mutable_row[key] == key + "newvalue"
+        assert mutable_row[idx] == key + "newvalue"
+
+    def test_set_failed(self, mutable_row):
+        with raises(ValueError, match="No 'absence' field."):
+            mutable_row.set("absence", "newvalue")
+
+    def test_set_multiple_fields(self):
+        row = Row(['a', 'b', 'b'], [1, 2, 3])
+
+        row.set('b', 4)
+
+        assert row.values() == (1, 4, 3)
+
+    def test_set_datetime_then_str(self):
+        row = Row(['a', 'b'], [1, 'x'])
+        str(row)
+
+        row.set('a', EPOCH)
+
+        assert row.values(reduce_datetimes=True) == (EPOCH_ISO, 'x')
+        assert str(row) == str(Row(['a', 'b'], [EPOCH, 'x']))
+
+    def test_set_datetime_then_export(self):
+        schema = RowSchema(['a', 'b'])
+        rowset = RowSet([Row(schema, [1, 'x']), Row(schema, [2, 'y'])])
+        rowset.export('csv')
+
+        rowset[1].set('a', EPOCH)
+
+        assert rowset.dataset[:] == [(1, 'x'), (EPOCH_ISO, 'y')]
+        assert EPOCH_ISO in rowset.export('json', stream=io.StringIO()).getvalue()
 
-        with raises(ValueError):
-            standard_row.set("absence", "newvalue")
+    def test_set_datetime_before_export(self):
+        schema = RowSchema(['a', 'b'])
+        rowset = RowSet([Row(schema, [1, 'x']), Row(schema, [2, 'y'])])
+
+        rowset[1].set('a', EPOCH)
+
+        assert rowset[1].values(reduce_datetimes=True) == (EPOCH_ISO, 'y')
+        assert rowset.export('csv') == 'a,b\r\n1,x\r\n{},y\r\n'.format(EPOCH_ISO)
+        assert EPOCH_ISO in rowset.export('csv', stream=io.StringIO()).getvalue()
+
+    def test_set_query_row(self, standard_database):
+        row = standard_database.query(DISPLAY_SIGNAL_Q).first()
+
+        row.set('name', 'newvalue')
+
+        assert row['name'] == 'newvalue'
 
     def test_save(self):
         pass
@@ -139,34 +303,43 @@ class TestRow:
 
     def test_export(self):
         keys = ['a', 'b', 'c', 'd']
-        values = [250, 'B', 'C', datetime.fromtimestamp(0).isoformat()]
-        expectation = json.dumps([OrderedDict(zip(keys, values))])
+        values = [250, 'B', 'C', EPOCH_ISO]
+        expectation = json.dumps([dict(zip(keys, values))], separators=(",", ":"), check_circular=False)
         row = Row(keys, values)
 
         outcome = row.export('json')
 
         assert outcome == expectation
 
+    def test_export_json_options(self, standard_row):
+        with raises(TypeError, match='indent'):
+            standard_row.export('json', indent=2)
+
     def test__reduce_datetimes(self):
         t = datetime.now()
-        origin = [t, 1, 'abc', True, None]
-        expectation = origin.copy()
-        expectation[0] = t.isoformat()
 
-        outcome = Row._reduce_datetimes(origin)
+        outcome = Row._reduce_datetimes([t, 1, 'abc', True, None])
 
-        assert outcome == expectation
+        assert outcome == (t.isoformat(), 1, 'abc', True, None)
 
 
 class TestRowSet:
     def test___init__(self):
-        rows = (i for i in range(10))
+        rows = iter(_RANGE10)
         rowset = RowSet(rows)
 
         assert rowset._pre_rows == rows
-        assert rowset._all_rows == []
+        assert len(rowset._all_rows) == 0
         assert rowset.pending is True
 
+    def test___init___list(self):
+        rows = list(range(10))
+        rowset = RowSet(rows)
+
+        assert rowset._all_rows is rows
+        assert rowset.pending is False
+        assert list(rowset) == rows
+
     def test___repr__(self, standard_rowset):
         assert standard_rowset.__repr__() == '<RowSet fetched=0 pending=True>'
 
@@ -183,15 +356,19 @@ class TestRowSet:
         assert len(row_list) == len(standard_rowset)
         assert standard_rowset.pending is False
 
-    def test___next__(self, standard_rowset):
+    def test___next__(self, standard_rowset, display_signal_rows):
+        expected_rows = len(display_signal_rows)
+        for _ in range(expected_rows):
+            next(standard_rowset)
+
+        assert len(standard_rowset) == expected_rows
+        assert standard_rowset.pending is True
         with raises(StopIteration):
-            row_list = []
-            while True:
-                row_list.append(next(standard_rowset))
-                assert len(row_list) == len(standard_rowset)
+            next(standard_rowset)
+        assert standard_rowset.pending is False
 
     def test___getitem__(self, standard_rowset):
-        rowset = RowSet((i for i in range(10)))
+        rowset = RowSet(iter(_RANGE10))
 
         index_result = rowset[5]
         slice_result = rowset[2:7]
@@ -202,13 +379,32 @@ class TestRowSet:
         assert list(slice_result) == list(range(2, 7))
 
     def test_dataset(self, standard_rowset):
-        assert isinstance(standard_rowset.dataset, tablib.Dataset)
+        ds = standard_rowset.dataset
+
+        assert type(ds).__module__.startswith("tablib")
+
+    def test_dataset_reduce_datetimes(self):
+        schema = RowSchema(['id', 'birthday'])
+        rowset = RowSet([Row(schema, [1, EPOCH]), Row(schema, [2, None]), Row(['id', 'birthday'], [3, EPOCH])])
+
+        data = rowset.dataset
+
+        assert data.headers == ['id', 'birthday']
+        assert data[:] == [(1, EPOCH_ISO), (2, None), (3, EPOCH_ISO)]
 
     def test_all(self, standard_rowset):
         standard_rowset.all()
 
         assert standard_rowset.pending is False
 
+    def test_all_after_partial_fetch(self):
+        rowset = RowSet(iter(_RANGE10))
+        rowset[2]
+
+        rowset.all()
+
+        assert rowset._all_rows == list(_RANGE10)
+
     def test_first(self, standard_rowset):
         assert standard_rowset.first() is standard_rowset[0]
 
@@ -219,24 +415,42 @@ class TestRowSet:
             empty_rowset.first()
 
     def test_one(self):
-        rowset = RowSet((i for i in range(8, 9)))
+        rowset = RowSet(iter((8,)))
 
         assert rowset.one() == 8
 
     def test_one_failed(self):
-        rowset = RowSet((i for i in range(10)))
+        rowset = RowSet(iter(_RANGE10))
 
         with raises(ValueError, match='Contains more than one row.'):
             rowset.one()
 
     def test_scalar(self):
-        rowset = RowSet(([str(i)] for i in range(10)))
+        rowset = RowSet(iter(_STR_RANGE10))
 
         assert rowset.scalar() == '0'
 
     def test_export(self):
         pass
 
+    def test_export_stream(self, standard_database):
+        for format in ('csv', 'json'):
+            expectation = standard_database.query(DISPLAY_SIGNAL_Q).export(format)
+
+            outcome = standard_database.query(DISPLAY_SIGNAL_Q).export(format, stream=io.StringIO())
+
+            assert outcome.getvalue() == expectation
+
+    def test_export_stream_jsonl(self, standard_rowset):
+        outcome = standard_rowset.export('jsonl', stream=io.StringIO()).getvalue().splitlines()
+
+        assert len(outcome) == len(standard_rowset)
+        assert json.loads(outcome[0]) == dict(standard_rowset.first())
+
+    def test_export_stream_empty(self):
+        assert RowSet([]).export('csv', stream=io.StringIO()).getvalue() == ''
+        assert RowSet([]).export('json', stream=io.StringIO()).getvalue() == '[]'
+
 
 class TestTable:
     def test___init__(self):
@@ -275,40 +489,122 @@ class TestTable:
     def test_delete(self):
         pass
 
-    def test_update(self):
-        pass
+    def test_update(self, standard_database):
+        executor = standard_database.get_table('display_signal').update(name='newvalue')
 
-    def test_select(self):
-        pass
+        assert executor._name == 'UPDATE'
+        assert executor._name == str(executor._pre).split()[0]
+
+    def test_select(self, standard_database):
+        executor = standard_database.get_table('display_signal').select()
+
+        assert executor._name == 'SELECT'
+        assert executor._name == str(executor._pre).split()[0]
 
     def test_join(self):
         pass
 
 
 class TestDatabase:
-    def test___init__(self):
-        database = Database("sqlite://")
+    def test___init__(self, in_memory_url):
+        database = Database(in_memory_url)
 
         assert database.open is True
 
     def test___repr__(self, standard_database):
         assert standard_database.__repr__() == '<Database open=True>'
 
+    def test_caching_schema(self):
+        Database.clear_reflection_cache()
+        with Database.caching_schema():
+            first = Database(db_url="sqlite:///tests/db.sqlite3")
+            second = Database(db_url="sqlite:///tests/db.sqlite3")
+        third = Database(db_url="sqlite:///tests/db.sqlite3")
+        Database.clear_reflection_cache()
+
+        assert first._meta is second._meta
+        assert third._meta is not first._meta
+
+    def test_caching_schema_in_memory(self, in_memory_url):
+        with Database.caching_schema():
+            first = Database(in_memory_url)
+            second = Database(in_memory_url)
+
+        assert first._meta is not second._meta
+
+    def test_reflect_cache_path(self, tmp_path):
+        path = tmp_path / 'meta.pickle'
+        first = Database(db_url="sqlite:///tests/db.sqlite3", reflect_cache_path=path)
+        second = Database(db_url="sqlite:///tests/db.sqlite3", reflect_cache_path=path)
+
+        assert path.exists()
+        assert sorted(second._meta.tables) == sorted(first._meta.tables)
+        assert second.get_table('display_signal').name == 'display_signal'
+
+    def test_reflect_cache_path_broken(self, tmp_path):
+        path = tmp_path / 'meta.pickle'
+        path.write_bytes(pickle.dumps(MetaData()))
+
+        database = Database(db_url="sqlite:///tests/db.sqlite3", reflect_cache_path=path)
+
+        assert 'display_signal' in database._meta.tables
+
+    def test_reflect_cache_path_unwritable(self, tmp_path):
+        path = tmp_path / 'missing' / 'meta.pickle'
+
+        database = Database(db_url="sqlite:///tests/db.sqlite3", reflect_cache_path=path)
+
+        assert 'display_signal' in database._meta.tables
+        assert not path.exists()
+
     def test_table_names(self, standard_database):
         assert standard_database.table_names[:3] == ['auth_group', 'auth_group_permissions', 'auth_permission']
 
-    def test_close(self):
-        database = Database("sqlite://")
-        database.close()
+    def test_close(self, closable_db):
+        closable_db.close()
 
-        assert database.open is False
-        assert database._conn.closed is True
+        assert closable_db.open is False
+        assert closable_db._conn.closed is True
 
     def test_query(self, standard_database):
         ans = standard_database.query("SELECT * FROM display_signal")
 
         assert isinstance(ans, RowSet)
 
+    def test_query_batches(self, standard_database, monkeypatch):
+        expectation = standard_database.query(DISPLAY_SIGNAL_Q).all()
+        monkeypatch.setattr(easysql, '_FETCH_SIZE', 3)
+
+        outcome = standard_database.query(DISPLAY_SIGNAL_Q).all()
+
+        assert [r.values() for r in outcome] == [r.values() for r in expectation]
+
+    def test_query_stream_parameter(self, in_memory_url):
+        database = Database(in_memory_url)
+
+        assert database.query("SELECT :stream AS s", stream=5).scalar() == 5
+
+    def test_stream_query(self, standard_database):
+        expectation = standard_database.query(DISPLAY_SIGNAL_Q).all()
+
+        rowset = standard_database.stream_query(DISPLAY_SIGNAL_Q)
+        first = rowset.first()
+        standard_database.query("SELECT COUNT(*) FROM display_signal").scalar()
+
+        assert first.values() == expectation.first().values()
+        assert [r.values() for r in rowset.all()] == [r.values() for r in expectation]
+
+    def test_query_shared_schema(self, standard_database):
+        first, second = standard_database.query(DISPLAY_SIGNAL_Q)[:2]
+
+        assert first._schema is second._schema
+
+    def test__compile(self):
+        clause = Database._compile("SELECT * FROM display_signal")
+
+        assert Database._compile("SELECT * FROM display_signal") is clause
+        assert str(clause) == "SELECT * FROM display_signal"
+
     def test_bulk_query(self):
         pass
 